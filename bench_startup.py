@@ -0,0 +1,103 @@
+"""Бенчмарк холодного старта: время импорта модулей и time-to-first-ack.
+
+    python bench_startup.py [--runs 5] [--port 8765]
+
+Каждый замер — в свежем интерпретаторе, как после scale-to-zero.
+time-to-first-ack — от запуска uvicorn до первого 200 на POST /webhook
+(payload со "skip", чтобы не трогать Telegram), time-to-ready — до
+"ready": true в /health (без Redis не наступит — будет показан таймаут).
+"""
+
+import argparse, json, os, statistics, subprocess, sys, time, urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MODULES = ["fastapi", "aiohttp", "redis.asyncio", "openai", "PIL.Image", "main"]
+
+IMPORT_SNIPPET = (
+    "import sys, time; sys.path.insert(0, {root!r}); "
+    "t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+)
+
+
+def import_time(module: str) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(root=ROOT, module=module)],
+        capture_output=True, text=True, check=True, cwd=ROOT,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _request(url: str, payload: dict = None) -> dict:
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=1) as resp:
+        return json.loads(resp.read())
+
+
+def startup_run(port: int, ready_timeout: float) -> tuple:
+    """(time-to-first-ack, time-to-ready или None) для одного запуска uvicorn"""
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        first_ack = None
+        while first_ack is None:
+            if proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {proc.returncode}")
+            try:
+                _request(f"{base}/webhook", {"skip": True})
+                first_ack = time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+
+        ready = None
+        while ready is None and time.perf_counter() - started < ready_timeout:
+            try:
+                if _request(f"{base}/health").get("ready"):
+                    ready = time.perf_counter() - started
+                    continue
+            except OSError:
+                pass
+            time.sleep(0.05)
+        return first_ack, ready
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def fmt(values: list) -> str:
+    return f"median {statistics.median(values) * 1000:7.0f} ms   min {min(values) * 1000:7.0f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ready-timeout", type=float, default=10.0)
+    args = parser.parse_args()
+
+    print(f"import time, {args.runs} runs, fresh interpreter each:")
+    for module in MODULES:
+        print(f"  {module:<15} {fmt([import_time(module) for _ in range(args.runs)])}")
+
+    acks, readies = [], []
+    for _ in range(args.runs):
+        ack, ready = startup_run(args.port, args.ready_timeout)
+        acks.append(ack)
+        if ready is not None:
+            readies.append(ready)
+
+    print(f"\nuvicorn cold start, {args.runs} runs:")
+    print(f"  first ack       {fmt(acks)}")
+    if readies:
+        print(f"  ready           {fmt(readies)}   ({len(readies)}/{args.runs} runs)")
+    else:
+        print(f"  ready           not reached within {args.ready_timeout:.0f}s (Redis unavailable?)")
+
+
+if __name__ == "__main__":
+    main()
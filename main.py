@@ -1,27 +1,103 @@
-"""
+"""Telegram-бот: WOW-инфографика для маркетплейсов (GPT-4o Vision + Krea AI)."""
+
+from __future__ import annotations
 
-import os, json, asyncio, base64, io, logging
+import os, json, time, uuid, random, asyncio, base64, hashlib, importlib, io, logging
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from typing import Optional
 
-import aiohttp
-import redis.asyncio as aioredis
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import JSONResponse
-from openai import AsyncOpenAI
-from PIL import Image, ImageDraw, ImageFont
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту"""
+
+    def __init__(self, name: str):
+        self._name   = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Тяжёлые зависимости не импортируем на старте: их догружает warm_up() уже
+# после того, как порт слушается, либо первый же вызов, которому они нужны
+aiohttp    = LazyModule("aiohttp")
+aioredis   = LazyModule("redis.asyncio")
+openai_sdk = LazyModule("openai")
+Image      = LazyModule("PIL.Image")
+ImageDraw  = LazyModule("PIL.ImageDraw")
+ImageFont  = LazyModule("PIL.ImageFont")
 
 # ─── Конфиг ───────────────────────────────────────────────────────────────────
 BOT_TOKEN   = os.getenv("BOT_TOKEN", "ВСТАВЬТЕ_ТОКЕН_СЮДА")
 OPENAI_KEY  = os.getenv("OPENAI_API_KEY", "ВСТАВЬТЕ_OPENAI_КЛЮЧ_СЮДА")
 KREA_API_KEY= os.getenv("KREA_API_KEY", "ВСТАВЬТЕ_KREA_КЛЮЧ_СЮДА")
-REDIS_URL   = os.getenv("REDIS_URL", "redis://localhost:6379")
+REDIS_URL   = os.getenv("REDIS_URL", "redis://localhost:6379")   # один узел, не Cluster (см. планировщик)
 SESSION_TTL = 3600
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "1.0"))  # сек на connect и команду: зависший Redis = ошибка, а не ожидание TCP
+
+# "two_call" — анализ фото и промпты фонов двумя запросами (как раньше),
+# "fused"    — один structured-output запрос отдаёт стратегии вместе с промптами
+GPT_ANALYSIS_MODE = os.getenv("GPT_ANALYSIS_MODE", "two_call")
+
+# Сколько вариантов фона просить у Krea за один запрос в режиме "разные".
+# 1 — батчинг выключен (num_images/seed не отправляются); если Krea отклонит
+# батч-запрос как невалидный (400/422), процесс сам откатится на одиночные.
+KREA_MAX_BATCH = int(os.getenv("KREA_MAX_BATCH", "1"))
+
+# Планировщик генераций: лимиты по умолчанию, переопределяются на тенанта
+# в Redis-хеше sched:cfg:<tenant> (weight, max_concurrency, daily_quota)
+SCHED_GLOBAL_MAX   = int(os.getenv("SCHED_GLOBAL_MAX", "4"))      # генераций на весь кластер
+SCHED_WORKERS      = int(os.getenv("SCHED_WORKERS", "2"))         # генераций на один процесс
+SCHED_TENANT_MAX   = int(os.getenv("SCHED_TENANT_MAX", "2"))      # генераций на тенанта
+SCHED_TENANT_QUOTA = int(os.getenv("SCHED_TENANT_QUOTA", "300"))  # картинок на тенанта в сутки
+SCHED_LEASE_TTL    = 120                                           # сек, продлевается heartbeat'ом
+SCHED_MAX_ATTEMPTS = 2                                             # запусков задачи, пережившей падение воркера
+
+# Лимиты внешних API на весь кластер: (запросов/сек, burst, одновременных, TTL lease сек).
+# TTL больше таймаута запроса, чтобы lease упавшего воркера протух сам.
+# Переопределяются env, например LIMIT_KREA_ENHANCE="0.5,2,2".
+PROVIDER_LIMITS = {
+    "krea_generations": (2.0, 4,  4,  45),
+    "krea_background":  (1.0, 2,  3,  90),
+    "krea_enhance":     (1.0, 2,  3,  90),
+    "krea_status":      (5.0, 10, 10, 45),
+    "openai_chat":      (5.0, 10, 8,  90),
+}
+for _ep, (_rate, _burst, _conc, _ttl) in PROVIDER_LIMITS.items():
+    if os.getenv(f"LIMIT_{_ep.upper()}"):
+        _rate, _burst, _conc = os.getenv(f"LIMIT_{_ep.upper()}").split(",")
+        PROVIDER_LIMITS[_ep] = (float(_rate), int(_burst), int(_conc), _ttl)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger(__name__)
 
-app    = FastAPI()
-openai = AsyncOpenAI(api_key=OPENAI_KEY)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Старт без тяжёлых импортов: прогрев идёт фоном, когда порт уже слушается"""
+    warm_task = asyncio.create_task(warm_up())
+    yield
+    # Сначала дожидаемся отмены прогрева: только после неё известно,
+    # запустил ли он планировщик и пинг Redis
+    warm_task.cancel()
+    await asyncio.gather(warm_task, return_exceptions=True)
+    tasks = [t for t in (_sched_task, _redis_ping_task) if t is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _krea_session is not None:
+        await _krea_session.close()
+    if _shared_redis is not None:
+        await _shared_redis.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
@@ -51,7 +127,125 @@ async def webhook(request: Request, bg: BackgroundTasks):
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    """Liveness всегда ok; ready — все подсистемы прогреты и Redis ответил на последний фоновый ping"""
+    return {"status": "ok", "ready": all(_ready.values()), "subsystems": _ready}
+
+
+@app.get("/stats/tenants")
+async def stats_tenants():
+    """Очередь, ожидание и пропускная способность генераций по тенантам"""
+    return await load_tenant_stats()
+
+
+@app.get("/stats/external")
+async def stats_external():
+    """Состояние circuit breaker'ов и p95 латентности внешних API (этот процесс)"""
+    return {
+        ep: {
+            "circuit":  _breakers[ep].state,
+            "failures": _breakers[ep].failures,
+            "p95_s":    _latencies[ep].p95(),
+            "hedge_s":  _latencies[ep].hedge_delay(),
+        }
+        for ep in PROVIDER_LIMITS
+    }
+
+
+@app.get("/stats/gpt")
+async def stats_gpt():
+    """Средняя латентность и токены GPT на одну сессию анализа — по режимам"""
+    return {mode: await load_gpt_stats(mode) for mode in ("two_call", "fused")}
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ЛЕНИВАЯ ИНИЦИАЛИЗАЦИЯ ПОДСИСТЕМ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+_ready = {"openai": False, "pil": False, "redis": False, "krea": False}
+
+_openai_client = None
+_krea_session  = None
+_fonts         = None
+
+_redis_ping_task  = None
+REDIS_PING_EVERY  = 5     # сек между фоновыми ping'ами для /health
+
+WARM_UP_MODULES = ("aiohttp", "redis.asyncio", "openai", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFont")
+
+
+def get_openai():
+    global _openai_client
+    if _openai_client is None:
+        # Повторы делает call_external: каждая попытка берёт свой lease с TTL > timeout
+        _openai_client = openai_sdk.AsyncOpenAI(api_key=OPENAI_KEY, timeout=60, max_retries=0)
+        _ready["openai"] = True
+    return _openai_client
+
+
+def get_krea_session():
+    """Общая aiohttp-сессия для Krea: keep-alive вместо TLS-рукопожатия на каждый запрос"""
+    global _krea_session
+    if _krea_session is None or _krea_session.closed:
+        _krea_session = aiohttp.ClientSession()
+        _ready["krea"] = True
+    return _krea_session
+
+
+def get_fonts():
+    global _fonts
+    if _fonts is None:
+        try:
+            _fonts = (
+                ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 56),
+                ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 36),
+            )
+        except OSError:
+            _fonts = (ImageFont.load_default(), ImageFont.load_default())
+        _ready["pil"] = True
+    return _fonts
+
+
+async def check_redis():
+    """Обновляет _ready["redis"]; в лог пишет только смену состояния"""
+    try:
+        await asyncio.wait_for(get_shared_redis().ping(), timeout=0.5)
+        if not _ready["redis"]:
+            log.info("Redis ping ok")
+        _ready["redis"] = True
+    except Exception as e:
+        if _ready["redis"] or _redis_ping_task is None:
+            log.error(f"Redis ping error: {e}")
+        _ready["redis"] = False
+
+
+async def redis_pinger():
+    while True:
+        await asyncio.sleep(REDIS_PING_EVERY)
+        await check_redis()
+
+
+async def warm_up():
+    """Прогрев после старта: импорты — в потоке, чтобы не держать event loop.
+
+    Планировщик и ping Redis стартуют после прогрева, даже неудачного,
+    но не при отмене на остановке сервера.
+    """
+    global _sched_task, _redis_ping_task
+    started = time.monotonic()
+    try:
+        for name in WARM_UP_MODULES:
+            t = time.monotonic()
+            await asyncio.to_thread(importlib.import_module, name)
+            log.info(f"warm_up: import {name} {int((time.monotonic() - t) * 1000)}ms")
+        get_openai()
+        get_krea_session()
+        await asyncio.to_thread(get_fonts)
+        await check_redis()
+    except Exception as e:
+        log.error(f"warm_up error: {e}")
+    log.info(f"warm_up: done in {int((time.monotonic() - started) * 1000)}ms, ready={_ready}")
+    _sched_task      = asyncio.create_task(scheduler_loop())
+    _redis_ping_task = asyncio.create_task(redis_pinger())
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -135,16 +329,30 @@ async def step_photo(payload: dict, sess: dict, token: str, chat_id: int):
 
     await send_msg(token, chat_id, "🧠 Анализирую товар и создаю маркетинговые стратегии...")
 
+    usage = {}
     try:
         photo_bytes = await download_tg_photo(token, photo_id)
-        strategies = await gpt_analyze_strategies(photo_bytes)
+        if GPT_ANALYSIS_MODE == "fused":
+            strategies = await gpt_analyze_fused(photo_bytes, usage)
+        else:
+            strategies = await gpt_analyze_strategies(photo_bytes, usage)
     except Exception as e:
         log.error(f"GPT strategies error: {e}")
         await send_msg(token, chat_id, "❌ Не смог проанализировать фото. Попробуйте другое.")
         return
 
+    # Сессия анализа попадает в статистику, только когда все её вызовы GPT
+    # реально прошли: fused — сразу, two_call — после промптов фонов на шаге B.
+    # Fallback без запроса (breaker открыт) оставляет usage пустым.
+    sess.pop("gpt_usage", None)
+    if usage and GPT_ANALYSIS_MODE == "fused":
+        await record_gpt_session(GPT_ANALYSIS_MODE, usage)
+    elif usage:
+        sess["gpt_usage"] = usage
+
     sess["photo_file_id"] = photo_id
     sess["strategies"]    = strategies
+    sess["analysis_mode"] = GPT_ANALYSIS_MODE
     sess["stage"]         = "await_strategy"
     await save_session(chat_id, sess)
 
@@ -161,11 +369,14 @@ async def step_photo(payload: dict, sess: dict, token: str, chat_id: int):
     await send_msg(token, chat_id, text, parse_mode="Markdown", reply_markup=kb)
 
 
-async def gpt_analyze_strategies(photo_bytes: bytes) -> list:
+async def gpt_analyze_strategies(photo_bytes: bytes, usage: Optional[dict] = None) -> list:
     """GPT-4o Vision: 3 маркетинговые стратегии"""
+    if circuit_open("openai_chat"):
+        return [dict(s) for s in FALLBACK_STRATEGIES]
     b64 = base64.b64encode(photo_bytes).decode()
     
-    resp = await openai.chat.completions.create(
+    started = time.monotonic()
+    resp = await gpt_chat(
         model="gpt-4o",
         messages=[{
             "role": "user",
@@ -199,6 +410,7 @@ async def gpt_analyze_strategies(photo_bytes: bytes) -> list:
         max_tokens=500,
         response_format={"type": "json_object"}
     )
+    await record_gpt_usage("two_call", "strategies", resp, started, usage)
     
     result = json.loads(resp.choices[0].message.content)
     if "strategies" in result:
@@ -207,11 +419,131 @@ async def gpt_analyze_strategies(photo_bytes: bytes) -> list:
         return result
     else:
         # Fallback если структура другая
-        return [
-            {"title": "Элитный", "strategy": "Премиум товар для ценителей", "marketing_hook": "Выбор профи"},
-            {"title": "Практичный", "strategy": "Надёжность на каждый день", "marketing_hook": "Просто работает"},
-            {"title": "Стильный", "strategy": "Модный дизайн", "marketing_hook": "Будь в тренде"}
-        ]
+        return [dict(s) for s in FALLBACK_STRATEGIES]
+
+
+FALLBACK_STRATEGIES = [
+    {"title": "Элитный", "strategy": "Премиум товар для ценителей", "marketing_hook": "Выбор профи"},
+    {"title": "Практичный", "strategy": "Надёжность на каждый день", "marketing_hook": "Просто работает"},
+    {"title": "Стильный", "strategy": "Модный дизайн", "marketing_hook": "Будь в тренде"}
+]
+
+FALLBACK_BG_PROMPTS = [
+    "Luxury interior with marble and gold, soft studio lighting, 8k",
+    "Modern minimalist setting, white background, professional photography",
+    "Natural outdoor scene, bokeh background, golden hour lighting"
+]
+
+# JSON Schema для structured outputs: стратегии сразу с 3 промптами фонов
+FUSED_SCHEMA = {
+    "name": "marketing_strategies",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "strategies": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title":              {"type": "string"},
+                        "strategy":           {"type": "string"},
+                        "marketing_hook":     {"type": "string"},
+                        "background_prompts": {"type": "array", "items": {"type": "string"}},
+                    },
+                    "required": ["title", "strategy", "marketing_hook", "background_prompts"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["strategies"],
+        "additionalProperties": False,
+    },
+}
+
+
+async def gpt_analyze_fused(photo_bytes: bytes, usage: Optional[dict] = None) -> list:
+    """GPT-4o Vision: 3 стратегии и по 3 промпта фонов на каждую — одним запросом"""
+    if circuit_open("openai_chat"):
+        return [dict(s, background_prompts=list(FALLBACK_BG_PROMPTS)) for s in FALLBACK_STRATEGIES]
+    b64 = base64.b64encode(photo_bytes).decode()
+
+    started = time.monotonic()
+    resp = await gpt_chat(
+        model="gpt-4o",
+        messages=[{
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
+                },
+                {
+                    "type": "text",
+                    "text": """Ты — маркетолог маркетплейсов. Проанализируй фото товара.
+
+Придумай 3 маркетинговые концепции. Каждая должна содержать:
+- `title`: название для кнопки (2-4 слова)
+- `strategy`: краткое описание стратегии (1 предложение)
+- `marketing_hook`: короткий текст для картинки (2-3 слова на русском, без точек)
+- `background_prompts`: ровно 3 детальных промпта для Krea AI на английском
+
+Примеры стратегий: "Элитный Интерьер", "Природный Лайфстайл", "Техно-Креатив", "Уличный Стиль", "Минимализм-Люкс"
+
+Требования к промптам фонов:
+- Фокусируйся на окружении, освещении и стиле
+- Промпты в стиле "high-end product photography, 8k, highly detailed textures, studio lighting"
+- Каждый промпт должен быть уникальным но в рамках концепции
+- Без упоминания конкретного товара (товар добавится автоматически)
+
+Примеры промптов:
+- "Luxury marble countertop with soft natural light, elegant interior, bokeh background, 8k"
+- "Urban rooftop at golden hour, city skyline, cinematic lighting, photorealistic"
+- "Minimalist scandinavian room, white walls, plants, natural daylight, high detail"
+
+Верни ТОЛЬКО JSON по заданной схеме."""
+                }
+            ]
+        }],
+        max_tokens=900,
+        response_format={"type": "json_schema", "json_schema": FUSED_SCHEMA}
+    )
+    await record_gpt_usage("fused", "fused", resp, started, usage)
+
+    try:
+        result = json.loads(resp.choices[0].message.content)
+    except (TypeError, ValueError):
+        # refusal или обрезанный ответ — уходим в fallback ниже
+        log.error(f"GPT fused bad response: {resp.choices[0].message.content!r}")
+        result = {}
+    return validate_fused_strategies(result)
+
+
+def validate_fused_strategies(result) -> list:
+    """Проверяет ответ fused-режима, битые поля заменяет fallback-значениями"""
+    items = result.get("strategies") if isinstance(result, dict) else None
+    strategies = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        if not all(isinstance(item.get(k), str) and item[k].strip()
+                   for k in ("title", "strategy", "marketing_hook")):
+            continue
+        raw_prompts = item.get("background_prompts")
+        prompts = [p for p in raw_prompts if isinstance(p, str) and p.strip()][:3] \
+            if isinstance(raw_prompts, list) else []
+        prompts += FALLBACK_BG_PROMPTS[len(prompts):]
+        strategies.append({
+            "title":              item["title"],
+            "strategy":           item["strategy"],
+            "marketing_hook":     item["marketing_hook"],
+            "background_prompts": prompts,
+        })
+
+    if not strategies:
+        log.error(f"GPT fused schema mismatch: {result!r}")
+        return [dict(s, background_prompts=list(FALLBACK_BG_PROMPTS)) for s in FALLBACK_STRATEGIES]
+    return strategies[:3]
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -236,9 +568,14 @@ async def step_strategy(payload: dict, sess: dict, token: str, chat_id: int):
     
     await send_msg(token, chat_id, f"✅ Выбрано: *{selected['title']}*\n\n⏳ Генерирую 3 варианта фонов...", parse_mode="Markdown")
     
-    # GPT-4o создаёт 3 промпта для Krea
+    # GPT-4o создаёт 3 промпта для Krea (в fused-режиме они уже есть в стратегии)
     try:
-        prompts = await gpt_create_background_prompts(selected)
+        prompts = selected.get("background_prompts")
+        if not prompts:
+            usage = sess.pop("gpt_usage", None)
+            prompts = await gpt_create_background_prompts(selected, usage)
+            if usage and usage["calls"] == 2:
+                await record_gpt_session(sess.get("analysis_mode", "two_call"), usage)
         previews = await krea_generate_previews(prompts)
     except Exception as e:
         log.error(f"Krea previews error: {e}")
@@ -268,9 +605,12 @@ async def step_strategy(payload: dict, sess: dict, token: str, chat_id: int):
     await send_msg(token, chat_id, "👆 Выберите фон:", reply_markup=kb)
 
 
-async def gpt_create_background_prompts(strategy: dict) -> list[str]:
+async def gpt_create_background_prompts(strategy: dict, usage: Optional[dict] = None) -> list[str]:
     """GPT-4o создаёт 3 промпта для Krea на основе стратегии"""
-    resp = await openai.chat.completions.create(
+    if circuit_open("openai_chat"):
+        return list(FALLBACK_BG_PROMPTS)
+    started = time.monotonic()
+    resp = await gpt_chat(
         model="gpt-4o",
         messages=[{
             "role": "user",
@@ -294,55 +634,60 @@ async def gpt_create_background_prompts(strategy: dict) -> list[str]:
         max_tokens=300,
         response_format={"type": "json_object"}
     )
+    await record_gpt_usage("two_call", "bg_prompts", resp, started, usage)
     
     result = json.loads(resp.choices[0].message.content)
     if "prompts" in result:
         return result["prompts"][:3]
     else:
         # Fallback
-        return [
-            "Luxury interior with marble and gold, soft studio lighting, 8k",
-            "Modern minimalist setting, white background, professional photography",
-            "Natural outdoor scene, bokeh background, golden hour lighting"
-        ]
+        return list(FALLBACK_BG_PROMPTS)
 
 
 async def krea_generate_previews(prompts: list[str]) -> list[str]:
-    """Генерирует 3 быстрых превью через Krea Flash"""
-    preview_urls = []
-    
-    async with aiohttp.ClientSession() as session:
-        for prompt in prompts:
-            try:
-                async with session.post(
-                    "https://api.krea.ai/v1/images/generations",
-                    headers={
-                        "Authorization": f"Bearer {KREA_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "prompt": prompt,
-                        "model": "krea-flash",
-                        "width": 512,
-                        "height": 512,
-                        "steps": 4
-                    },
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        preview_urls.append(data["images"][0]["url"])
-                    else:
-                        log.error(f"Krea preview error: {await resp.text()}")
-                        # Fallback: используем заглушку
-                        preview_urls.append("https://via.placeholder.com/512?text=Preview")
-            except Exception as e:
-                log.error(f"Krea preview exception: {e}")
-                preview_urls.append("https://via.placeholder.com/512?text=Error")
-            
-            await asyncio.sleep(0.5)
-    
-    return preview_urls
+    """Генерирует 3 быстрых превью через Krea Flash (параллельно, с hedging)"""
+    session = get_krea_session()
+    return list(await asyncio.gather(*(_krea_preview(session, p) for p in prompts)))
+
+
+PREVIEW_CACHE_SIZE = 500
+_preview_cache = {}   # prompt → последний удачный URL превью
+
+
+async def _krea_preview(session: aiohttp.ClientSession, prompt: str) -> str:
+    async def attempt():
+        async with provider_limit("krea_generations"), session.post(
+            "https://api.krea.ai/v1/images/generations",
+            headers={
+                "Authorization": f"Bearer {KREA_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "prompt": prompt,
+                "model": "krea-flash",
+                "width": 512,
+                "height": 512,
+                "steps": 4
+            },
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as resp:
+            if resp.status != 200:
+                raise ExternalAPIError(resp.status, f"Krea preview error: {await resp.text()}")
+            data = await resp.json()
+            return data["images"][0]["url"]
+
+    try:
+        url = await call_external("krea_generations", attempt, hedge=True)
+    except Exception as e:
+        log.error(f"Krea preview exception: {e}")
+        # Fallback: прошлое превью этого промпта или заглушка
+        return _preview_cache.get(prompt, "https://via.placeholder.com/512?text=Preview")
+
+    _preview_cache.pop(prompt, None)
+    _preview_cache[prompt] = url
+    if len(_preview_cache) > PREVIEW_CACHE_SIZE:
+        _preview_cache.pop(next(iter(_preview_cache)))
+    return url
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -453,17 +798,36 @@ async def start_generation(sess: dict, token: str, chat_id: int):
     qty = sess.get("qty", 1)
     mp_mode = sess.get("mp_mode", "wb")
     total = qty * 3 if mp_mode == "all" else qty
+    # В серии одинаковые картинки генерируются один раз на маркетплейс
+    unique = total if sess.get("series_mode") == "different" else total // qty
+
+    try:
+        queued, running = await sched_submit(sess.copy(), token, chat_id, total)
+    except Exception as e:
+        # Redis недоступен — работаем как раньше, без общей очереди
+        log.error(f"[{chat_id}] scheduler submit error: {e}")
+        asyncio.create_task(run_generation(sess.copy(), token, chat_id))
+        queued, running = 0, 0
+
+    if queued < 0:
+        await save_session(chat_id, {"stage": "await_photo"})
+        await send_msg(token, chat_id, "⚠️ Дневной лимит генераций исчерпан. Попробуйте завтра.")
+        return
 
     await send_msg(token, chat_id,
         f"🎨 Запускаю генерацию {total} {'изображения' if total < 5 else 'изображений'}...\n\n"
-        f"Это займёт ~{total * 45}–{total * 60} секунд.\n\n"
+        f"Это займёт ~{unique * 45}–{unique * 60} секунд.\n\n"
         f"Этапы:\n"
         f"1️⃣ Krea Background Generation (~30 сек)\n"
         f"2️⃣ Krea Enhancer 4K (~20 сек)\n"
         f"3️⃣ Наложение инфографики\n\n"
         f"Ожидайте... ⏳")
 
-    asyncio.create_task(run_generation(sess.copy(), token, chat_id))
+    # Точное место зависит от весов ботов, поэтому показываем общую загрузку
+    if queued > 1 or running >= SCHED_GLOBAL_MAX:
+        await send_msg(token, chat_id,
+            f"🕐 Сейчас выполняется генераций: {running}, ждут в очереди: {queued - 1}.\n"
+            f"Ваша начнётся, как только освободится место.")
 
 
 async def run_generation(sess: dict, token: str, chat_id: int):
@@ -480,33 +844,720 @@ async def run_generation(sess: dict, token: str, chat_id: int):
         all_media = []
 
         for mp_key in mp_list:
-            for i in range(qty):
-                log.info(f"[{chat_id}] Генерируем {mp_key} #{i+1}/{qty}")
+            # Шаг 3: Krea Background Generation (вживление товара).
+            # Серия — один уникальный (фото, промпт, mp_key) считаем один раз
+            # и размножаем; "разные" — варианты пачками с разными seed.
+            if series_mode == "different":
+                composed = await krea_background_variants(photo_bytes, bg_prompt, mp_key, qty)
+            else:
+                composed = (await krea_background_generation(photo_bytes, bg_prompt, mp_key))[:1]
+            if not composed:
+                raise Exception("Krea API returned no images")
 
-                # Шаг 3: Krea Background Generation (вживление товара)
-                composed_bytes = await krea_background_generation(
-                    photo_bytes, bg_prompt, mp_key
-                )
+            finals = []
+            for j, composed_bytes in enumerate(composed):
+                log.info(f"[{chat_id}] Генерируем {mp_key} #{j+1}/{len(composed)} (qty={qty})")
 
                 # Шаг 4: Krea Enhancer (апскейл до 4K)
                 enhanced_bytes = await krea_enhance(composed_bytes, mp_key)
 
                 # Шаг 5: Наложение инфографики
-                final_bytes = await add_infographic_overlay(
+                finals.append(await add_infographic_overlay(
                     enhanced_bytes, strategy, mp_key
-                )
+                ))
 
-                all_media.append((final_bytes, mp_key, i + 1))
+            for i in range(qty):
+                all_media.append((finals[i % len(finals)], mp_key, i + 1))
 
         await send_results(token, chat_id, all_media, mp_list, qty)
 
         await save_session(chat_id, {"stage": "await_photo"})
         await send_msg(token, chat_id, "✅ Готово! Пришлите новое фото 📷")
+        return True
 
     except Exception as e:
         log.error(f"[{chat_id}] generation error: {e}", exc_info=True)
         await save_session(chat_id, {"stage": "await_photo"})
         await send_msg(token, chat_id, f"❌ Ошибка: {str(e)[:200]}\n\nПопробуйте снова.")
+        return False
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ПЛАНИРОВЩИК ГЕНЕРАЦИЙ (взвешенная справедливая очередь по тенантам)
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Тенант = бот (X-Bot-Token), задача = генерация одного чата. Очереди, лимиты,
+# квоты и leases лежат в Redis, поэтому действуют на все реплики. Порядок —
+# start-time fair queuing: у тенанта виртуальное время, которое растёт на
+# cost/weight за каждую запущенную задачу (cost = число картинок), и первым
+# обслуживается тенант с наименьшим временем. Большая пачка одного бота не
+# блокирует остальных: он просто уходит в конец виртуальной шкалы.
+#
+# sched:q:<tenant>       — list с JSON задач (внутри токен бота и сессия)
+# sched:tenants          — zset тенантов с непустой очередью → виртуальное время
+# sched:vfinish          — hash виртуального времени тенантов с пустой очередью
+# sched:active[:tenant]  — zset lease → срок lease (мс); протухшие = упавший воркер
+# sched:running          — hash lease → JSON запущенной задачи
+#
+# lease = "<job_id>:<номер запуска>": у повторного запуска после reap свой
+# lease, и зависший старый воркер не снимет и не продлит чужой.
+#
+# Постоянные ключи передаются в скрипты через KEYS, но ключи тенантов
+# (sched:q:, sched:active:, sched:cfg:) скрипты собирают сами из имени
+# тенанта — нужен Redis одним узлом, Redis Cluster не поддерживается.
+#
+# Квота списывается при постановке в очередь и возвращается, если генерация
+# упала. Задачу с протухшим lease одна из реплик забирает (sched_reap) и ставит
+# в начало очереди; после SCHED_MAX_ATTEMPTS запусков она снимается, квота
+# возвращается, а чат получает сообщение и выходит из стадии "generating".
+
+SCHED_SUBMIT_LUA = """
+local used  = tonumber(redis.call('GET', KEYS[3]) or '0')
+local quota = tonumber(redis.call('HGET', KEYS[4], 'daily_quota') or ARGV[3])
+local cost  = tonumber(ARGV[4])
+if used + cost > quota then
+  return {-1, 0}
+end
+redis.call('INCRBY', KEYS[3], cost)
+redis.call('EXPIRE', KEYS[3], 172800)
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[5], ARGV[1])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+  local vclock = tonumber(redis.call('GET', KEYS[6]) or '0')
+  local last   = tonumber(redis.call('HGET', KEYS[7], ARGV[1]) or '0')
+  redis.call('ZADD', KEYS[2], tostring(math.max(vclock, last)), ARGV[1])
+end
+local queued = 0
+for _, tenant in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+  queued = queued + redis.call('LLEN', 'sched:q:' .. tenant)
+end
+return {queued, redis.call('ZCOUNT', KEYS[8], ARGV[5], '+inf')}
+"""
+
+SCHED_REQUEUE_LUA = """
+redis.call('LPUSH', KEYS[1], ARGV[2])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+  local vclock = tonumber(redis.call('GET', KEYS[3]) or '0')
+  local last   = tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or '0')
+  redis.call('ZADD', KEYS[2], tostring(math.max(vclock, last)), ARGV[1])
+end
+return 1
+"""
+
+SCHED_REAP_LUA = """
+local jobs = {}
+for _, lease in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])) do
+  redis.call('ZREM', KEYS[1], lease)
+  local raw = redis.call('HGET', KEYS[2], lease)
+  if raw then
+    redis.call('HDEL', KEYS[2], lease)
+    redis.call('ZREM', 'sched:active:' .. cjson.decode(raw).tenant, lease)
+    table.insert(jobs, raw)
+  end
+end
+return jobs
+"""
+
+SCHED_POP_LUA = """
+local now    = tonumber(ARGV[1])
+local expiry = now + tonumber(ARGV[2])
+if redis.call('ZCOUNT', KEYS[1], now, '+inf') >= tonumber(ARGV[3]) then
+  return false
+end
+local tenants = redis.call('ZRANGE', KEYS[2], 0, -1, 'WITHSCORES')
+for i = 1, #tenants, 2 do
+  local tenant = tenants[i]
+  local start  = tonumber(tenants[i + 1])
+  local akey   = 'sched:active:' .. tenant
+  local qkey   = 'sched:q:' .. tenant
+  redis.call('ZREMRANGEBYSCORE', akey, '-inf', now)
+  local cfg    = redis.call('HMGET', 'sched:cfg:' .. tenant, 'max_concurrency', 'weight')
+  local cap    = tonumber(cfg[1]) or tonumber(ARGV[4])
+  local weight = tonumber(cfg[2]) or 1
+  if redis.call('ZCARD', akey) < cap then
+    local raw = redis.call('LPOP', qkey)
+    if raw then
+      local job    = cjson.decode(raw)
+      local finish = start + job.cost / weight
+      redis.call('SET', KEYS[3], tostring(start))
+      redis.call('ZADD', akey, expiry, job.lease)
+      redis.call('ZADD', KEYS[1], expiry, job.lease)
+      redis.call('HSET', KEYS[4], job.lease, raw)
+      if redis.call('LLEN', qkey) > 0 then
+        redis.call('ZADD', KEYS[2], tostring(finish), tenant)
+      else
+        redis.call('ZREM', KEYS[2], tenant)
+        redis.call('HSET', KEYS[5], tenant, tostring(finish))
+      end
+      return raw
+    end
+    redis.call('ZREM', KEYS[2], tenant)
+  end
+end
+return false
+"""
+
+# 1 — lease ещё наш и снят; 0 — его уже забрал reap, задачей владеет другой запуск
+SCHED_RELEASE_LUA = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+  return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return 1
+"""
+
+_sched_running   = 0
+_sched_task      = None
+_sched_reaped_at = 0.0
+_sched_wakeup  = asyncio.Event()
+
+
+def tenant_id(token: str) -> str:
+    """Ключ тенанта без самого токена — для логов и имён ключей Redis"""
+    return hashlib.sha256(token.encode()).hexdigest()[:12]
+
+
+async def sched_submit(sess: dict, token: str, chat_id: int, cost: int) -> tuple[int, int]:
+    """Ставит генерацию в очередь тенанта.
+
+    Возвращает (задач в очереди всех тенантов вместе с этой, выполняется сейчас);
+    (-1, 0) — дневная квота тенанта исчерпана.
+    """
+    r = get_shared_redis()
+    tenant = tenant_id(token)
+    job = {
+        "id":      f"{tenant}:{chat_id}:{uuid.uuid4().hex[:8]}",
+        "tenant":  tenant,
+        "token":   token,
+        "chat_id": chat_id,
+        "sess":    sess,
+        "cost":    cost,
+        "enq_ts":  time.time(),
+    }
+    job["lease"] = f"{job['id']}:1"
+    day = time.strftime("%Y%m%d", time.gmtime())
+    job["quota_key"] = f"sched:used:{tenant}:{day}"
+    queued, running = await lua_script(r, "submit", SCHED_SUBMIT_LUA)(
+        keys=[f"sched:q:{tenant}", "sched:tenants", job["quota_key"], f"sched:cfg:{tenant}",
+              "sched:known", "sched:vclock", "sched:vfinish", "sched:active"],
+        args=[tenant, json.dumps(job), SCHED_TENANT_QUOTA, cost, int(time.time() * 1000)],
+    )
+    log.info(f"[{chat_id}] sched submit tenant={tenant} cost={cost} queued={queued} running={running}")
+    _sched_wakeup.set()
+    return int(queued), int(running)
+
+
+async def scheduler_loop():
+    """Забирает задачи из общей очереди, пока у процесса есть свободные воркеры"""
+    global _sched_running, _sched_reaped_at
+    while True:
+        try:
+            if time.monotonic() - _sched_reaped_at > 5:
+                _sched_reaped_at = time.monotonic()
+                await sched_reap()
+
+            raw = None
+            if _sched_running < SCHED_WORKERS:
+                r = get_shared_redis()
+                raw = await lua_script(r, "pop", SCHED_POP_LUA)(
+                    keys=["sched:active", "sched:tenants", "sched:vclock", "sched:running", "sched:vfinish"],
+                    args=[int(time.time() * 1000), SCHED_LEASE_TTL * 1000, SCHED_GLOBAL_MAX, SCHED_TENANT_MAX],
+                )
+            if raw:
+                _sched_running += 1
+                asyncio.create_task(_sched_run(json.loads(raw)))
+                continue
+        except Exception as e:
+            log.error(f"scheduler loop error: {e}")
+
+        # Ждём submit в этом процессе, освободившийся воркер или просто опрашиваем
+        _sched_wakeup.clear()
+        try:
+            await asyncio.wait_for(_sched_wakeup.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def sched_reap():
+    """Задачи упавших воркеров: повторный запуск или снятие с возвратом квоты"""
+    r = get_shared_redis()
+    reaped = await lua_script(r, "reap", SCHED_REAP_LUA)(
+        keys=["sched:active", "sched:running"], args=[int(time.time() * 1000)],
+    )
+    for raw in reaped:
+        job = json.loads(raw)
+        job["attempts"] = job.get("attempts", 1) + 1
+        if job["attempts"] <= SCHED_MAX_ATTEMPTS:
+            log.error(f"[{job['chat_id']}] sched lease expired, requeue {job['id']}")
+            job["enq_ts"] = time.time()
+            job["lease"] = f"{job['id']}:{job['attempts']}"
+            await lua_script(r, "requeue", SCHED_REQUEUE_LUA)(
+                keys=[f"sched:q:{job['tenant']}", "sched:tenants", "sched:vclock", "sched:vfinish"],
+                args=[job["tenant"], json.dumps(job)],
+            )
+            continue
+
+        log.error(f"[{job['chat_id']}] sched lease expired, dropping {job['id']}")
+        await _sched_refund(job)
+        await save_session(job["chat_id"], {"stage": "await_photo"})
+        await send_msg(job["token"], job["chat_id"], "❌ Генерация прервалась. Пришлите фото и попробуйте снова.")
+
+
+async def _sched_refund(job: dict):
+    try:
+        await get_shared_redis().decrby(job["quota_key"], job["cost"])
+    except Exception as e:
+        log.error(f"sched refund error: {e}")
+
+
+async def _sched_run(job: dict):
+    global _sched_running
+    tenant, lease = job["tenant"], job["lease"]
+    started = time.time()
+    wait_ms = int((started - job["enq_ts"]) * 1000)
+    log.info(f"[{job['chat_id']}] sched start tenant={tenant} wait={wait_ms}ms")
+
+    heartbeat = asyncio.create_task(_sched_heartbeat(tenant, lease))
+    ok = False
+    try:
+        await _sched_stat(tenant, jobs_started=1, wait_ms=wait_ms)
+        ok = await run_generation(job["sess"], job["token"], job["chat_id"])
+        if ok:
+            await _sched_stat(tenant, jobs_done=1, images=job["cost"],
+                              run_ms=int((time.time() - started) * 1000))
+        else:
+            await _sched_stat(tenant, jobs_failed=1)
+    finally:
+        heartbeat.cancel()
+        _sched_running -= 1
+        # Без lease задачу уже забрал reap: квоту вернёт он или следующий запуск
+        owned = False
+        try:
+            owned = await lua_script(get_shared_redis(), "release", SCHED_RELEASE_LUA)(
+                keys=["sched:running", "sched:active", f"sched:active:{tenant}"], args=[lease],
+            ) == 1
+            if not owned:
+                log.error(f"[{job['chat_id']}] sched lease {lease} was reaped while running")
+        except Exception as e:
+            log.error(f"sched release error: {e}")
+        if owned and not ok:
+            await _sched_refund(job)
+        _sched_wakeup.set()
+
+
+async def _sched_heartbeat(tenant: str, lease: str):
+    """Продлевает свой lease, пока задача жива; у упавшего воркера он протухнет сам"""
+    while True:
+        await asyncio.sleep(SCHED_LEASE_TTL / 3)
+        try:
+            r = get_shared_redis()
+            expiry = int(time.time() * 1000) + SCHED_LEASE_TTL * 1000
+            async with r.pipeline(transaction=True) as pipe:
+                pipe.zadd(f"sched:active:{tenant}", {lease: expiry}, xx=True)
+                pipe.zadd("sched:active", {lease: expiry}, xx=True)
+                await pipe.execute()
+        except Exception as e:
+            log.error(f"sched heartbeat error: {e}")
+
+
+async def _sched_stat(tenant: str, images: int = 0, **counters):
+    try:
+        r = get_shared_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            for field, value in counters.items():
+                pipe.hincrby(f"sched:stats:{tenant}", field, value)
+            if images:
+                pipe.hincrby(f"sched:stats:{tenant}", "images", images)
+                minute_key = f"sched:tput:{tenant}:{int(time.time() // 60)}"
+                pipe.incrby(minute_key, images)
+                pipe.expire(minute_key, 3700)
+            await pipe.execute()
+    except Exception as e:
+        log.error(f"sched stat error: {e}")
+
+
+async def load_tenant_stats() -> dict:
+    r = get_shared_redis()
+    now_ms = int(time.time() * 1000)
+    minute = int(time.time() // 60)
+    day = time.strftime("%Y%m%d", time.gmtime())
+
+    result = {}
+    for tenant in sorted(await r.smembers("sched:known")):
+        stats = {k: int(v) for k, v in (await r.hgetall(f"sched:stats:{tenant}")).items()}
+        hour = await r.mget([f"sched:tput:{tenant}:{m}" for m in range(minute - 59, minute + 1)])
+        started = stats.get("jobs_started", 0)
+        done = stats.get("jobs_done", 0)
+        result[tenant] = {
+            "queued":            await r.llen(f"sched:q:{tenant}"),
+            "active":            await r.zcount(f"sched:active:{tenant}", now_ms, "+inf"),
+            "jobs_started":      started,
+            "jobs_done":         done,
+            "jobs_failed":       stats.get("jobs_failed", 0),
+            "images":            stats.get("images", 0),
+            "avg_wait_s":        round(stats.get("wait_ms", 0) / started / 1000, 1) if started else None,
+            "avg_run_s":         round(stats.get("run_ms", 0) / done / 1000, 1) if done else None,
+            "images_last_hour":  sum(int(v) for v in hour if v),
+            "quota_used_today":  int(await r.get(f"sched:used:{tenant}:{day}") or 0),
+        }
+    return result
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ЛИМИТЫ ВНЕШНИХ API (token bucket + concurrency leases на весь кластер)
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Один Lua-скрипт атомарно проверяет concurrency (zset lease → срок) и
+# списывает токен из bucket'а. Время берётся из Redis (TIME), чтобы часы
+# реплик не расходились. Lease снимается по выходу из provider_limit, а у
+# упавшего воркера протухает через TTL. Без Redis — локальные лимиты процесса.
+
+LIMIT_ACQUIRE_LUA = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t     = redis.call('TIME')
+local now   = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local rate  = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local ttl   = tonumber(ARGV[4])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[3]) then
+  local first = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+  return math.max(1, math.min(250, tonumber(first[2]) - now))
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts     = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+if tokens < 1 then
+  return math.ceil((1 - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+redis.call('ZADD', KEYS[2], now + ttl, ARGV[5])
+redis.call('PEXPIRE', KEYS[2], ttl)
+return 0
+"""
+
+LIMIT_MAX_WAIT    = 120   # сек ожидания слота, дальше — ошибка вызова
+LIMIT_REDIS_RETRY = 10    # сек работы на локальных лимитах после отказа Redis
+
+
+class LocalLimit:
+    """Fallback без Redis: тот же token bucket и семафор, но в пределах процесса"""
+
+    def __init__(self, rate: float, burst: int, concurrency: int):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = float(burst)
+        self.ts     = time.monotonic()
+        self.sem    = asyncio.Semaphore(concurrency)
+
+    async def acquire(self):
+        await self.sem.acquire()
+        try:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        except BaseException:
+            # отмена во время ожидания токена (например, проигравший hedge)
+            self.sem.release()
+            raise
+
+    def release(self):
+        self.sem.release()
+
+
+_local_limits   = {}
+_limit_degraded = 0.0   # monotonic-время следующей попытки Redis, 0 — Redis в строю
+
+
+async def _acquire_cluster_slot(endpoint: str, lease_id: str):
+    rate, burst, concurrency, ttl = PROVIDER_LIMITS[endpoint]
+    script = lua_script(get_shared_redis(), "limit_acquire", LIMIT_ACQUIRE_LUA)
+    deadline = time.monotonic() + LIMIT_MAX_WAIT
+    while True:
+        wait_ms = await script(
+            keys=[f"lim:bucket:{endpoint}", f"lim:lease:{endpoint}"],
+            args=[rate, burst, concurrency, ttl * 1000, lease_id],
+        )
+        if not wait_ms:
+            return
+        if time.monotonic() > deadline:
+            raise Exception(f"{endpoint}: rate limit wait exceeded {LIMIT_MAX_WAIT}s")
+        # jitter, чтобы ждущие реплики не ломились в Redis одновременно
+        await asyncio.sleep(int(wait_ms) / 1000 * random.uniform(1.0, 1.5))
+
+
+@asynccontextmanager
+async def provider_limit(endpoint: str):
+    """Слот внешнего API: ждёт токен и свободный concurrency lease"""
+    global _limit_degraded
+    lease_id = uuid.uuid4().hex
+    local = None
+    try:
+        # После отказа Redis не дёргаем его LIMIT_REDIS_RETRY секунд
+        if _limit_degraded and time.monotonic() < _limit_degraded:
+            raise aioredis.ConnectionError("limiter in local mode")
+        await _acquire_cluster_slot(endpoint, lease_id)
+        if _limit_degraded:
+            log.info("limiter: Redis is back, cluster limits restored")
+            _limit_degraded = 0.0
+    except aioredis.RedisError as e:
+        if not _limit_degraded or time.monotonic() >= _limit_degraded:
+            log.error(f"limiter: Redis unavailable ({e}), falling back to local limits")
+            _limit_degraded = time.monotonic() + LIMIT_REDIS_RETRY
+        if endpoint not in _local_limits:
+            _local_limits[endpoint] = LocalLimit(*PROVIDER_LIMITS[endpoint][:3])
+        local = _local_limits[endpoint]
+        await local.acquire()
+
+    # Слот получен: отсюда call_external меряет латентность самого провайдера
+    clock = _attempt_clock.get()
+    if clock is not None:
+        clock.started_at = time.monotonic()
+        clock.slot.set()
+
+    try:
+        yield
+    finally:
+        if local:
+            local.release()
+        else:
+            try:
+                await get_shared_redis().zrem(f"lim:lease:{endpoint}", lease_id)
+            except Exception as e:
+                log.error(f"limiter release error: {e}")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# УСТОЙЧИВОСТЬ ВНЕШНИХ ВЫЗОВОВ (hedging, retries, circuit breakers)
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# call_external() оборачивает одну попытку запроса:
+#   • circuit breaker на endpoint: после BREAKER_FAILURES сбоев подряд вызовы
+#     BREAKER_COOLDOWN сек сразу падают с CircuitOpenError, вызывающий отдаёт
+#     кэш/fallback; потом один пробный запрос решает, закрыть ли его;
+#   • повтор временных ошибок (сеть, таймаут, 429, 5xx) с full-jitter backoff;
+#     платные POST в Krea повторяются, только если запрос точно не принят
+#     (нет соединения, 429, 503) — см. not_accepted();
+#   • для идемпотентных запросов (превью, статус задачи) — hedging: если ответа
+#     нет дольше p95 латентности endpoint'а, параллельно уходит дубль, берём
+#     первый успешный. Каждая попытка сама берёт слот в provider_limit.
+# Латентность и hedge-таймер считаются с момента получения слота: ожидание
+# в лимитере — не медленный провайдер, и дубль его только усугубит.
+
+BREAKER_FAILURES = 5      # временных сбоев подряд до открытия
+BREAKER_COOLDOWN = 30     # сек в открытом состоянии до пробного запроса
+RETRY_BASE       = 0.5    # сек, база экспоненциального backoff
+RETRY_CAP        = 8      # сек, потолок одной паузы
+
+# Задержка hedge, пока не набралось LATENCY_MIN_SAMPLES замеров для p95
+HEDGE_DEFAULT_DELAY = {"krea_generations": 6.0, "krea_status": 1.5}
+LATENCY_MIN_SAMPLES = 20
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class ExternalAPIError(Exception):
+    """Ответ внешнего API с кодом != 200"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitBreaker:
+    def __init__(self, endpoint: str):
+        self.endpoint  = endpoint
+        self.failures  = 0
+        self.opened_at = 0.0
+        self.probing   = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < BREAKER_FAILURES:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self.probing):
+            raise CircuitOpenError(f"{self.endpoint}: circuit open")
+        if state == "half_open":
+            self.probing = True
+
+    def record(self, ok: bool):
+        self.probing = False
+        if ok:
+            if self.failures >= BREAKER_FAILURES:
+                log.info(f"circuit {self.endpoint}: closed")
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            if self.failures == BREAKER_FAILURES or time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                log.error(f"circuit {self.endpoint}: open for {BREAKER_COOLDOWN}s")
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.samples  = deque(maxlen=200)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        return max(0.2, p95) if p95 is not None else HEDGE_DEFAULT_DELAY.get(self.endpoint, 5.0)
+
+
+_breakers  = {ep: CircuitBreaker(ep) for ep in PROVIDER_LIMITS}
+_latencies = {ep: LatencyTracker(ep) for ep in PROVIDER_LIMITS}
+
+
+def circuit_open(endpoint: str) -> bool:
+    """Для fail-fast с fallback до запроса: endpoint сейчас не принимает вызовы"""
+    return _breakers[endpoint].state == "open"
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return True
+    if isinstance(e, ExternalAPIError):
+        status = e.status
+    elif type(e).__module__.startswith("openai."):
+        # openai_sdk трогаем только для его же ошибок — SDK к этому моменту загружен
+        if isinstance(e, openai_sdk.APIConnectionError):
+            return True
+        status = getattr(e, "status_code", None)
+    else:
+        return False
+    return status is not None and (status == 429 or status >= 500)
+
+
+def not_accepted(e: Exception) -> bool:
+    """Запрос точно не принят провайдером: повтор не создаст вторую платную задачу.
+
+    Таймаут чтения или 500 сюда не входят — задача могла уже запуститься.
+    """
+    if isinstance(e, aiohttp.ClientConnectorError):
+        return True
+    return isinstance(e, ExternalAPIError) and e.status in (429, 503)
+
+
+async def call_external(endpoint: str, attempt, hedge: bool = False, retries: int = 2,
+                        retry_if=is_transient):
+    """Вызов внешнего API: breaker → повторы с jitter → (hedged) попытка
+
+    Сбоем для breaker'а считается любая временная ошибка, а повторяются
+    только те, что проходят retry_if.
+    """
+    breaker = _breakers[endpoint]
+    for n in range(retries + 1):
+        breaker.before_call()
+        try:
+            result = await (_hedged(endpoint, attempt) if hedge else _timed(endpoint, attempt))
+        except Exception as e:
+            if not is_transient(e):
+                breaker.probing = False
+                raise
+            breaker.record(False)
+            if n == retries or breaker.state == "open" or not retry_if(e):
+                raise
+            delay = random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** n))
+            log.warning(f"{endpoint}: {type(e).__name__} {e}, retry {n + 1}/{retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record(True)
+            return result
+
+
+class AttemptClock:
+    """Момент, когда попытка получила слот в provider_limit"""
+
+    def __init__(self):
+        self.started_at = None
+        self.slot       = asyncio.Event()
+
+
+_attempt_clock: ContextVar[Optional[AttemptClock]] = ContextVar("attempt_clock", default=None)
+
+
+async def _timed(endpoint: str, attempt, clock: Optional[AttemptClock] = None):
+    clock = clock or AttemptClock()
+    token = _attempt_clock.set(clock)
+    try:
+        result = await attempt()
+    except asyncio.CancelledError:
+        # Проигравший hedge: время до отмены — нижняя оценка, но без него
+        # выборка обрезана на точке hedge и p95 со временем ползёт вниз
+        if clock.started_at is not None:
+            _latencies[endpoint].add(time.monotonic() - clock.started_at)
+        raise
+    finally:
+        _attempt_clock.reset(token)
+    if clock.started_at is not None:
+        _latencies[endpoint].add(time.monotonic() - clock.started_at)
+    return result
+
+
+async def _hedged(endpoint: str, attempt):
+    """Первая попытка, а после p95 без ответа — дубль; побеждает первый успех"""
+    clock = AttemptClock()
+    tasks = {asyncio.create_task(_timed(endpoint, attempt, clock))}
+    slot = asyncio.create_task(clock.slot.wait())
+    try:
+        # Hedge-таймер запускается, только когда первая попытка получила слот
+        await asyncio.wait(tasks | {slot}, return_when=asyncio.FIRST_COMPLETED)
+        done, _ = await asyncio.wait(tasks, timeout=_latencies[endpoint].hedge_delay())
+        if not done:
+            log.info(f"{endpoint}: hedging slow request")
+            tasks.add(asyncio.create_task(_timed(endpoint, attempt, AttemptClock())))
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        slot.cancel()
+        for task in tasks:
+            task.cancel()
+            # проигравший дубль мог успеть упасть — не шумим "exception never retrieved"
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def gpt_chat(**kwargs):
+    """chat.completions.create под кластерным лимитом и breaker'ом OpenAI"""
+    async def attempt():
+        async with provider_limit("openai_chat"):
+            return await get_openai().chat.completions.create(**kwargs)
+
+    return await call_external("openai_chat", attempt)
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -516,12 +1567,16 @@ async def run_generation(sess: dict, token: str, chat_id: int):
 async def krea_background_generation(
     product_photo: bytes,
     background_prompt: str,
-    mp_key: str
-) -> bytes:
-    """Шаг 3: Krea вырезает товар и вплавляет его в фон"""
+    mp_key: str,
+    num_images: int = 1,
+    seed: Optional[int] = None
+) -> list[bytes]:
+    """Шаг 3: Krea вырезает товар и вплавляет его в фон (num_images вариантов за запрос)"""
     w, h, _ = MP_SIZES[mp_key]
 
-    async with aiohttp.ClientSession() as session:
+    session = get_krea_session()
+
+    async def attempt():
         form = aiohttp.FormData()
         form.add_field("image", product_photo, filename="product.jpg")
         form.add_field("prompt", background_prompt)
@@ -529,24 +1584,71 @@ async def krea_background_generation(
         form.add_field("height", str(h))
         form.add_field("model", "krea-pro")
         form.add_field("steps", "20")
+        if num_images > 1:
+            form.add_field("num_images", str(num_images))
+        if seed is not None:
+            form.add_field("seed", str(seed))
 
-        async with session.post(
+        async with provider_limit("krea_background"), session.post(
             "https://api.krea.ai/v1/images/background-generation",
             headers={"Authorization": f"Bearer {KREA_API_KEY}"},
             data=form,
             timeout=aiohttp.ClientTimeout(total=60)
         ) as resp:
             if resp.status != 200:
-                raise Exception(f"Krea API error: {await resp.text()}")
-            data = await resp.json()
-            
-            if "id" in data:
-                result = await _wait_for_krea_result(session, data["id"])
-                return result
-            else:
-                image_url = data["images"][0]["url"]
-                async with session.get(image_url) as img_resp:
-                    return await img_resp.read()
+                raise ExternalAPIError(resp.status, f"Krea API error: {await resp.text()}")
+            return await resp.json()
+
+    # Платный неидемпотентный запрос: без hedging, один повтор и только если
+    # Krea запрос точно не приняла — иначе таймаут обернётся двойной оплатой
+    data = await call_external("krea_background", attempt, retries=1, retry_if=not_accepted)
+
+    if "id" in data:
+        return await _wait_for_krea_result(session, data["id"])
+    else:
+        return await _download_krea_images(session, data["images"])
+
+
+async def krea_background_variants(
+    product_photo: bytes,
+    background_prompt: str,
+    mp_key: str,
+    count: int
+) -> list[bytes]:
+    """Режим "разные": count вариантов фона минимумом платных запросов.
+
+    Просим до KREA_MAX_BATCH картинок за запрос; если Krea вернула меньше
+    (батч не поддержан), добираем остаток запросами с другим seed. Если
+    Krea отвергла num_images/seed (400/422), дальше шлём обычные одиночные запросы.
+    """
+    global _krea_batching
+    images = []
+    seed = random.randrange(2**31)
+    while len(images) < count:
+        if _krea_batching:
+            batch = min(KREA_MAX_BATCH, count - len(images))
+            try:
+                got = await krea_background_generation(
+                    product_photo, background_prompt, mp_key,
+                    num_images=batch, seed=seed + len(images)
+                )
+            except ExternalAPIError as e:
+                # Только отказ от самих полей; 429, 401/403 и прочее — наверх
+                if e.status not in (400, 422):
+                    raise
+                log.warning(f"Krea rejected batched request ({e.status}), falling back to single requests")
+                _krea_batching = False
+                continue
+        else:
+            batch = 1
+            got = await krea_background_generation(product_photo, background_prompt, mp_key)
+        if not got:
+            raise Exception("Krea API returned no images")
+        images.extend(got[:batch])
+    return images
+
+
+_krea_batching = KREA_MAX_BATCH > 1
 
 
 async def krea_enhance(image_bytes: bytes, mp_key: str) -> bytes:
@@ -555,51 +1657,69 @@ async def krea_enhance(image_bytes: bytes, mp_key: str) -> bytes:
     target_w = w * 2
     target_h = h * 2
 
-    async with aiohttp.ClientSession() as session:
+    session = get_krea_session()
+
+    async def attempt():
         form = aiohttp.FormData()
         form.add_field("image", image_bytes, filename="input.png")
         form.add_field("width", str(target_w))
         form.add_field("height", str(target_h))
         form.add_field("enhance_level", "high")
 
-        async with session.post(
+        async with provider_limit("krea_enhance"), session.post(
             "https://api.krea.ai/v1/images/enhance",
             headers={"Authorization": f"Bearer {KREA_API_KEY}"},
             data=form,
             timeout=aiohttp.ClientTimeout(total=60)
         ) as resp:
             if resp.status != 200:
-                raise Exception(f"Krea Enhance error: {await resp.text()}")
-            data = await resp.json()
-            
-            if "id" in data:
-                result = await _wait_for_krea_result(session, data["id"])
-                return result
-            else:
-                image_url = data["images"][0]["url"]
-                async with session.get(image_url) as img_resp:
-                    return await img_resp.read()
+                raise ExternalAPIError(resp.status, f"Krea Enhance error: {await resp.text()}")
+            return await resp.json()
+
+    try:
+        data = await call_external("krea_enhance", attempt, retries=1, retry_if=not_accepted)
+    except CircuitOpenError:
+        # Enhancer лежит — отдаём картинку без апскейла, оверлей сам подгонит размер
+        log.warning("Krea Enhance circuit open, skipping upscale")
+        return image_bytes
+
+    if "id" in data:
+        return (await _wait_for_krea_result(session, data["id"]))[0]
+    else:
+        return (await _download_krea_images(session, data["images"][:1]))[0]
 
 
-async def _wait_for_krea_result(session: aiohttp.ClientSession, job_id: str) -> bytes:
+async def _wait_for_krea_result(session: aiohttp.ClientSession, job_id: str) -> list[bytes]:
     """Ждёт результата асинхронной задачи Krea"""
-    for _ in range(60):
-        await asyncio.sleep(2)
-        async with session.get(
+    async def attempt():
+        async with provider_limit("krea_status"), session.get(
             f"https://api.krea.ai/v1/images/{job_id}",
-            headers={"Authorization": f"Bearer {KREA_API_KEY}"}
+            headers={"Authorization": f"Bearer {KREA_API_KEY}"},
+            timeout=aiohttp.ClientTimeout(total=30)
         ) as resp:
-            data = await resp.json()
-            if data["status"] == "completed":
-                image_url = data["images"][0]["url"]
-                async with session.get(image_url) as img_resp:
-                    return await img_resp.read()
-            elif data["status"] == "failed":
-                raise Exception("Krea generation failed")
+            if resp.status != 200:
+                raise ExternalAPIError(resp.status, f"Krea status error: {await resp.text()}")
+            return await resp.json()
+
+    for _ in range(60):
+        await asyncio.sleep(2)
+        data = await call_external("krea_status", attempt, hedge=True)
+        if data["status"] == "completed":
+            return await _download_krea_images(session, data["images"])
+        elif data["status"] == "failed":
+            raise Exception("Krea generation failed")
     
     raise Exception("Krea timeout")
 
 
+async def _download_krea_images(session: aiohttp.ClientSession, images: list) -> list[bytes]:
+    result = []
+    for image in images:
+        async with session.get(image["url"]) as img_resp:
+            result.append(await img_resp.read())
+    return result
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # ШАГ 5 — НАЛОЖЕНИЕ ИНФОГРАФИКИ
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -618,12 +1738,7 @@ async def add_infographic_overlay(
         img = img.resize((w, h), Image.Resampling.LANCZOS)
         draw = ImageDraw.Draw(img)
     
-    try:
-        font_title = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 56)
-        font_body  = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 36)
-    except:
-        font_title = ImageFont.load_default()
-        font_body  = ImageFont.load_default()
+    font_title, font_body = get_fonts()
     
     hook = strategy["marketing_hook"]
     
@@ -755,24 +1870,108 @@ async def download_tg_photo(token: str, file_id: str) -> bytes:
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
-# REDIS (с reconnect logic)
+# МЕТРИКИ GPT (бенчмарк two_call vs fused)
 # ═══════════════════════════════════════════════════════════════════════════════
 
-async def get_redis():
-    """Получает Redis соединение с retry logic"""
+GPT_USAGE_FIELDS = ("latency_ms", "prompt_tokens", "completion_tokens")
+
+
+async def record_gpt_usage(mode: str, call: str, resp, started: float,
+                           session: Optional[dict] = None):
+    """Пишет латентность и токены одного запроса в счётчики режима.
+
+    session — накопитель сессии анализа, его потом сдаёт record_gpt_session.
+    """
+    usage = getattr(resp, "usage", None)
+    sample = {
+        "latency_ms":        int((time.monotonic() - started) * 1000),
+        "prompt_tokens":     getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+    }
+    log.info(f"gpt mode={mode} call={call} latency={sample['latency_ms']}ms "
+             f"prompt_tokens={sample['prompt_tokens']} completion_tokens={sample['completion_tokens']}")
+    if session is not None:
+        session["calls"] = session.get("calls", 0) + 1
+        for field in GPT_USAGE_FIELDS:
+            session[field] = session.get(field, 0) + sample[field]
+    try:
+        r = get_shared_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.hincrby(f"stats:gpt:{mode}", f"{call}:calls", 1)
+            for field in GPT_USAGE_FIELDS:
+                pipe.hincrby(f"stats:gpt:{mode}", f"{call}:{field}", sample[field])
+            await pipe.execute()
+    except Exception as e:
+        log.error(f"record_gpt_usage error: {e}")
+
+
+async def record_gpt_session(mode: str, session: dict):
+    """Завершённая сессия анализа = фото → стратегии (→ промпты фонов)"""
     try:
-        return await aioredis.from_url(REDIS_URL, decode_responses=True)
+        r = get_shared_redis()
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.hincrby(f"stats:gpt:{mode}", "sessions", 1)
+            for field in GPT_USAGE_FIELDS:
+                pipe.hincrby(f"stats:gpt:{mode}", f"session:{field}", session.get(field, 0))
+            await pipe.execute()
     except Exception as e:
-        log.error(f"Redis connection error: {e}")
-        await asyncio.sleep(0.5)
-        return await aioredis.from_url(REDIS_URL, decode_responses=True)
+        log.error(f"record_gpt_session error: {e}")
+
+
+async def load_gpt_stats(mode: str) -> dict:
+    try:
+        r = get_shared_redis()
+        raw = await r.hgetall(f"stats:gpt:{mode}")
+    except Exception as e:
+        log.error(f"load_gpt_stats error: {e}")
+        return {}
+
+    counters = {k: int(v) for k, v in raw.items()}
+    stats = {"sessions": counters.get("sessions", 0), "calls": {}}
+    if stats["sessions"]:
+        for field in GPT_USAGE_FIELDS:
+            stats[f"avg_{field}"] = counters.get(f"session:{field}", 0) // stats["sessions"]
+
+    # Средние по каждому вызову — включая сессии, брошенные на полпути
+    for key, calls in counters.items():
+        if not key.endswith(":calls") or not calls:
+            continue
+        call = key[:-len(":calls")]
+        stats["calls"][call] = {"calls": calls, **{
+            f"avg_{field}": counters.get(f"{call}:{field}", 0) // calls for field in GPT_USAGE_FIELDS
+        }}
+    return stats
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# REDIS (общий пул соединений, создаётся при первом обращении)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+_shared_redis = None
+_lua_scripts  = {}
+
+
+def get_shared_redis():
+    """Долгоживущий клиент с пулом соединений; переподключается сам"""
+    global _shared_redis
+    if _shared_redis is None:
+        _shared_redis = aioredis.from_url(
+            REDIS_URL, decode_responses=True,
+            socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT,
+        )
+    return _shared_redis
+
+
+def lua_script(r, name: str, source: str):
+    if name not in _lua_scripts:
+        _lua_scripts[name] = r.register_script(source)
+    return _lua_scripts[name]
 
 
 async def load_session(chat_id: int) -> dict:
     try:
-        r = await get_redis()
+        r = get_shared_redis()
         raw = await r.get(f"session:{chat_id}")
-        await r.close()
         return json.loads(raw) if raw else {"stage": "await_photo"}
     except Exception as e:
         log.error(f"load_session error: {e}")
@@ -781,18 +1980,16 @@ async def load_session(chat_id: int) -> dict:
 
 async def save_session(chat_id: int, sess: dict):
     try:
-        r = await get_redis()
+        r = get_shared_redis()
         await r.setex(f"session:{chat_id}", SESSION_TTL, json.dumps(sess))
-        await r.close()
     except Exception as e:
         log.error(f"save_session error: {e}")
 
 
 async def delete_session(chat_id: int):
     try:
-        r = await get_redis()
+        r = get_shared_redis()
         await r.delete(f"session:{chat_id}")
-        await r.close()
     except Exception as e:
         log.error(f"delete_session error: {e}")
 